@@ -1,197 +1,578 @@
 import os
 import logging
+import asyncio
+import functools
+from dataclasses import dataclass
 from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.constants import ChatAction
+from telegram.ext import (
+    ApplicationBuilder,
+    BasePersistence,
+    CommandHandler,
+    ContextTypes,
+    MessageHandler,
+    PersistenceInput,
+    filters,
+)
 import asyncpg
 from dotenv import load_dotenv
-import dashscope
-import json
-
-# Загрузка переменных окружения из файла .env
-load_dotenv()
+import aiohttp
+from aiolimiter import AsyncLimiter
+import orjson
+import re
+import weakref
+from collections import OrderedDict
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG  # Установите уровень логирования на DEBUG для подробной информации
-)
 logger = logging.getLogger(__name__)
 
-# Используем переменные окружения для хранения токена и ключа API
-TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-QWEN_APP_ID = os.getenv('QWEN_APP_ID')
-QWEN_API_KEY = os.getenv('QWEN_API_KEY')
-POSTGRES_USER = os.getenv('POSTGRES_USER')
-POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-POSTGRES_HOST = os.getenv('POSTGRES_HOST')
-POSTGRES_PORT = int(os.getenv('POSTGRES_PORT'))
-POSTGRES_DB = os.getenv('POSTGRES_DB')
+# Настройки API Qwen 2.5 Max
+QWEN_BASE_URL = 'https://dashscope-intl.aliyuncs.com/api/v1'
 
-if not TELEGRAM_BOT_TOKEN or not QWEN_APP_ID or not QWEN_API_KEY:
-    logger.error("Не найдены переменные окружения TELEGRAM_BOT_TOKEN, QWEN_APP_ID или QWEN_API_KEY")
-    exit(1)
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Настройки бота из переменных окружения."""
+    telegram_bot_token: str
+    qwen_app_id: str
+    qwen_api_key: str
+    postgres_user: str
+    postgres_password: str
+    postgres_host: str
+    postgres_port: int
+    postgres_db: str
 
-if not POSTGRES_USER or not POSTGRES_PASSWORD or not POSTGRES_HOST or not POSTGRES_PORT or not POSTGRES_DB:
-    logger.error("Не найдены переменные окружения для подключения к базе данных")
-    exit(1)
+    @property
+    def qwen_completion_url(self):
+        return f'{QWEN_BASE_URL}/apps/{self.qwen_app_id}/completion'
 
-# Установка API ключа
-dashscope.api_key = QWEN_API_KEY
+@functools.cache
+def cfg():
+    """Читает и проверяет настройки при первом обращении."""
+    # Загрузка переменных окружения из файла .env
+    load_dotenv()
 
-# Настройки API Qwen 2.5 Max
-dashscope.base_http_api_url = 'https://dashscope-intl.aliyuncs.com/api/v1'
+    # Используем переменные окружения для хранения токена и ключа API
+    telegram_bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
+    qwen_app_id = os.getenv('QWEN_APP_ID')
+    qwen_api_key = os.getenv('QWEN_API_KEY')
+    postgres_user = os.getenv('POSTGRES_USER')
+    postgres_password = os.getenv('POSTGRES_PASSWORD')
+    postgres_host = os.getenv('POSTGRES_HOST')
+    postgres_port = os.getenv('POSTGRES_PORT')
+    postgres_db = os.getenv('POSTGRES_DB')
 
-# Функция для подключения к базе данных
-async def get_db_connection():
-    try:
-        conn = await asyncpg.connect(
-            user=POSTGRES_USER,
-            password=POSTGRES_PASSWORD,
-            database=POSTGRES_DB,
-            host=POSTGRES_HOST,
-            port=POSTGRES_PORT
+    if not telegram_bot_token or not qwen_app_id or not qwen_api_key:
+        logger.error("Не найдены переменные окружения TELEGRAM_BOT_TOKEN, QWEN_APP_ID или QWEN_API_KEY")
+        exit(1)
+
+    if not postgres_user or not postgres_password or not postgres_host or not postgres_port or not postgres_db:
+        logger.error("Не найдены переменные окружения для подключения к базе данных")
+        exit(1)
+
+    return Config(
+        telegram_bot_token=telegram_bot_token,
+        qwen_app_id=qwen_app_id,
+        qwen_api_key=qwen_api_key,
+        postgres_user=postgres_user,
+        postgres_password=postgres_password,
+        postgres_host=postgres_host,
+        postgres_port=int(postgres_port),
+        postgres_db=postgres_db
+    )
+
+# Запросы к таблице контекста пользователей
+SELECT_CONTEXT_SQL = 'SELECT context FROM user_context WHERE chat_id = $1'
+UPSERT_CONTEXT_SQL = '''
+    INSERT INTO user_context (chat_id, context) VALUES ($1, $2)
+    ON CONFLICT (chat_id) DO UPDATE SET context = EXCLUDED.context
+'''
+DELETE_CONTEXT_SQL = 'DELETE FROM user_context WHERE chat_id = $1'
+
+class ContextConnection(asyncpg.Connection):
+    """Соединение с заранее подготовленными запросами к таблице user_context."""
+
+# Двоичный формат JSONB: байт версии 1, за которым следует JSON-текст
+def _encode_jsonb(value):
+    return b'\x01' + orjson.dumps(value)
+
+def _decode_jsonb(data):
+    return orjson.loads(memoryview(data)[1:])
+
+async def init_connection(conn):
+    """Настраивает новое соединение пула: кодек JSONB и подготовленные запросы."""
+    # Драйвер сам преобразует JSONB в списки Python и обратно через orjson
+    await conn.set_type_codec(
+        'jsonb',
+        encoder=_encode_jsonb,
+        decoder=_decode_jsonb,
+        schema='pg_catalog',
+        format='binary'
+    )
+    conn.select_context = await conn.prepare(SELECT_CONTEXT_SQL)
+    conn.upsert_context = await conn.prepare(UPSERT_CONTEXT_SQL)
+    conn.delete_context = await conn.prepare(DELETE_CONTEXT_SQL)
+
+# Сколько последних пар "вопрос-ответ" хранится и передаётся в API Qwen
+MAX_TURNS = 10
+
+class PostgresPersistence(BasePersistence):
+    """Хранит историю чатов (chat_data['ctx']) в таблице user_context.
+
+    PTB держит chat_data в памяти и сохраняет изменённые чаты раз в
+    update_interval секунд, поэтому несколько сообщений подряд из одного
+    чата дают одну запись в базу данных.
+
+    История загружается не при запуске, а при первом обращении чата
+    (refresh_chat_data). PTB не вытесняет chat_data, поэтому память
+    растёт с числом чатов, писавших боту с момента запуска, — это
+    принятая цена за отсутствие запроса к базе данных на каждое сообщение.
+    """
+
+    __slots__ = ('_pool', '_pending_contexts', '_pending_flush')
+
+    def __init__(self, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=False, callback_data=False),
+            update_interval=update_interval
         )
-        logger.debug(f"Successfully connected to the database {POSTGRES_DB}")
-        return conn
-    except Exception as e:
-        logger.error(f"Error connecting to the database {POSTGRES_DB}: {e}")
-        raise
+        self._pool = None
+        # Контексты, ожидающие записи одним пакетом, и общий результат этой записи
+        self._pending_contexts = {}
+        self._pending_flush = None
 
-# Функция для сохранения контекста пользователя
-async def save_context(chat_id, context):
-    conn = await get_db_connection()
-    try:
-        logger.debug(f"Saving context for chat_id {chat_id}: {context}")
-        await conn.execute('''
-            INSERT INTO user_context (chat_id, context) VALUES ($1, $2)
-            ON CONFLICT (chat_id) DO UPDATE SET context = EXCLUDED.context
-        ''', chat_id, json.dumps(context))  # Сохраняем контекст как JSON-строку
-        logger.info(f"Context saved successfully for chat_id {chat_id}")
-    except Exception as e:
-        logger.error(f"Error saving context for chat_id {chat_id}: {e}")
-    finally:
-        await conn.close()
+    async def _get_pool(self):
+        if self._pool is None:
+            config = cfg()
+            try:
+                self._pool = await asyncpg.create_pool(
+                    user=config.postgres_user,
+                    password=config.postgres_password,
+                    database=config.postgres_db,
+                    host=config.postgres_host,
+                    port=config.postgres_port,
+                    min_size=2,
+                    max_size=20,
+                    connection_class=ContextConnection,
+                    init=init_connection
+                )
+                logger.debug("Successfully created connection pool for the database %s", config.postgres_db)
+            except Exception as e:
+                logger.error("Error connecting to the database %s: %s", config.postgres_db, e)
+                raise
+        return self._pool
 
-# Функция для получения контекста пользователя
-async def get_context(chat_id):
-    conn = await get_db_connection()
-    try:
-        logger.debug(f"Fetching context for chat_id {chat_id}")
-        result = await conn.fetchrow('SELECT context FROM user_context WHERE chat_id = $1', chat_id)
-        if result and result['context']:
-            logger.debug(f"Context found for chat_id {chat_id}: {result['context']}")
-            return json.loads(result['context'])  # Преобразуем JSON-строку обратно в список
+    async def get_chat_data(self):
+        # Подключаемся к базе данных при запуске, чтобы сразу увидеть ошибку настроек;
+        # сами истории чатов загружаются по требованию в refresh_chat_data
+        await self._get_pool()
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        # Чаты без истории (например, после /start) не записываем
+        if not data.get('ctx'):
+            return
+        self._pending_contexts[chat_id] = data['ctx']
+        if self._pending_flush is not None:
+            # Запись уже запланирована другим вызовом — ждём её результата;
+            # shield не даёт отмене этого вызова отменить общую запись
+            await asyncio.shield(self._pending_flush)
+            return
+        flushed = self._pending_flush = asyncio.get_running_loop().create_future()
+        contexts = {}
+        try:
+            # PTB вызывает update_chat_data для всех изменённых чатов одновременно:
+            # уступаем цикл событий, чтобы остальные вызовы успели добавить свои контексты
+            await asyncio.sleep(0)
+            contexts, self._pending_contexts = self._pending_contexts, {}
+            await self._write_contexts(contexts)
+        except BaseException as e:
+            # Незаписанные контексты вернутся в очередь, если чат не обновился за это время
+            for pending_chat_id, context in contexts.items():
+                self._pending_contexts.setdefault(pending_chat_id, context)
+            if isinstance(e, asyncio.CancelledError):
+                flushed.cancel()
+            else:
+                flushed.set_exception(e)
+                flushed.exception()  # Ошибку получает этот вызов, предупреждение asyncio не нужно
+            raise
         else:
-            logger.info(f"No context found for chat_id {chat_id}")
-            return []
-    except Exception as e:
-        logger.error(f"Error fetching context for chat_id {chat_id}: {e}")
-        return []
-    finally:
-        await conn.close()
+            flushed.set_result(None)
+        finally:
+            self._pending_flush = None
+
+    async def _write_contexts(self, contexts):
+        """Сохраняет контексты нескольких чатов одним пакетом на одном соединении."""
+        try:
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                # Содержимое контекста может быть большим, строим запись только при уровне DEBUG
+                if logger.isEnabledFor(logging.DEBUG):
+                    for chat_id, context in contexts.items():
+                        logger.debug("Saving context for chat_id %s: %s", chat_id, context)
+                try:
+                    # executemany атомарен: ошибка в одной строке отменяет весь пакет
+                    await conn.upsert_context.executemany(contexts.items())
+                except asyncpg.PostgresError as e:
+                    # Пакет отклонён из-за данных — сохраняем чаты по одному, чтобы
+                    # ошибочная строка не мешала записи остальных
+                    logger.error("Error saving context batch, retrying per chat: %s", e)
+                    for chat_id, context in contexts.items():
+                        try:
+                            await conn.upsert_context.fetch(chat_id, context)
+                        except asyncpg.PostgresError as e:
+                            logger.error("Error saving context for chat_id %s: %s", chat_id, e)
+                    return
+            logger.info("Context saved successfully for %s chats", len(contexts))
+        except Exception as e:
+            logger.error("Error saving context for chat_ids %s: %s", list(contexts), e)
+            raise
+
+    async def drop_chat_data(self, chat_id):
+        # Пакетная запись, которая может содержать этот чат, должна завершиться
+        # до удаления, иначе её UPSERT восстановит удалённую историю
+        if self._pending_flush is not None:
+            try:
+                await asyncio.shield(self._pending_flush)
+            except Exception:
+                pass  # Ошибка записи уже записана в лог в _write_contexts
+        # Контекст, ожидающий повторной записи, не должен восстановить удалённую историю
+        self._pending_contexts.pop(chat_id, None)
+        try:
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                await conn.delete_context.fetch(chat_id)
+            logger.info("Deleted context for chat_id %s", chat_id)
+        except Exception as e:
+            logger.error("Error deleting context for chat_id %s: %s", chat_id, e)
+            raise
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        # PTB вызывает этот метод перед каждым обработчиком; из базы данных читаем только первый раз
+        if 'ctx' in chat_data:
+            return
+        try:
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                logger.debug("Fetching context for chat_id %s", chat_id)
+                context = await conn.select_context.fetchval(chat_id)
+        except Exception as e:
+            # Без загруженной истории обработчик перезаписал бы её, поэтому сообщение не обрабатываем
+            logger.error("Error fetching context for chat_id %s: %s", chat_id, e)
+            raise
+        # Пока шёл запрос, параллельное обновление могло уже сохранить новый контекст
+        chat_data.setdefault('ctx', context or [])
+
+    async def flush(self):
+        # Вызывается при остановке бота после сохранения всех изменений
+        if self._pending_contexts:
+            # Контексты, не записанные из-за прошлых ошибок, пробуем сохранить ещё раз
+            contexts, self._pending_contexts = self._pending_contexts, {}
+            try:
+                await self._write_contexts(contexts)
+            except Exception:
+                pass  # Ошибка уже записана в лог в _write_contexts
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+            logger.debug("Connection pool for the database %s closed", cfg().postgres_db)
+
+    # Остальные данные бота не сохраняются
+    async def get_user_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# Создание HTTP-сессии при запуске бота
+async def post_init(application):
+    config = cfg()
+    # Корутины, завершающиеся без ожидания, выполняются сразу (Python 3.12+)
+    if hasattr(asyncio, 'eager_task_factory'):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    # Общая HTTP-сессия для API Qwen: соединения переиспользуются между запросами
+    application.bot_data['http_session'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60),
+        headers={'Authorization': f'Bearer {config.qwen_api_key}'},
+        json_serialize=lambda obj: orjson.dumps(obj).decode()
+    )
+
+# Закрытие HTTP-сессии при остановке бота
+async def post_shutdown(application):
+    session = application.bot_data.pop('http_session', None)
+    if session is not None:
+        await session.close()
+
+# Функция для запроса к API Qwen 2.5 Max
+async def call_qwen(session, prompt, messages):
+    """Отправляет запрос приложению Qwen и возвращает текст ответа или None."""
+    payload = {'input': {'prompt': prompt, 'messages': messages}, 'parameters': {}}
+    async with session.post(cfg().qwen_completion_url, json=payload) as response:
+        data = await response.json(loads=orjson.loads)
+        if response.status != 200 or 'output' not in data:
+            logger.error("Qwen API error %s: %s %s", response.status, data.get('code'), data.get('message'))
+            return None
+        return data['output']['text']
+
+# Таблица для удаления обратных слэшей, которые используются для экранирования символов
+_STRIP_BACKSLASH = str.maketrans('', '', '\\')
 
 def clean_markdown(text):
     """Удаляет экранирование символов Markdown."""
-    # Удаляем обратные слэши, которые используются для экранирования символов
-    return text.replace('\\', '')
-
-def format_list_as_markdown(response_text):
-    """Форматирует список в текстовом ответе в Markdown."""
-    formatted_text = ""
-    lines = response_text.split("\n")
-    for line in lines:
-        if line.strip().startswith("-"):
-            formatted_text += f"• {line[1:].strip()}\n"
-        elif line.strip().startswith("1.") or line.strip().startswith("2.") or line.strip().startswith("3.") or line.strip().startswith("4.") or line.strip().startswith("5."):
-            formatted_text += f"{line.strip()}\n"
-        else:
-            formatted_text += f"{line.strip()}\n"
-    return formatted_text
+    return text.translate(_STRIP_BACKSLASH)
+
+# Обратный слэш или маркер элемента списка "-" в начале строки
+_RESPONSE_MARKUP_RE = re.compile(r'\\|^[ \t]*-[ \t]*', re.M)
+
+def _replace_response_markup(match):
+    return '' if match.group(0) == '\\' else '• '
+
+def format_response(response_text):
+    """Форматирует список в ответе в Markdown и удаляет экранирование за один проход."""
+    return _RESPONSE_MARKUP_RE.sub(_replace_response_markup, response_text)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start."""
     await update.message.reply_text('Привет! Я бот, который взаимодействует с Qwen 2.5 Max API. Отправь мне запрос.')
 
+# Ограничения Telegram на отправку: 30 сообщений в секунду на бота,
+# 1 сообщение в секунду в личный чат и 20 сообщений в минуту в группу
+_global_send_limiter = AsyncLimiter(30, 1)
+CHAT_LIMITERS_SIZE = 10_000
+_chat_send_limiters = OrderedDict()
+
+def _chat_send_limiter(chat_id):
+    """Возвращает ограничитель отправки для чата, вытесняя давно не использованные."""
+    limiter = _chat_send_limiters.get(chat_id)
+    if limiter is None:
+        # Идентификаторы групп и каналов отрицательные
+        limiter = AsyncLimiter(20, 60) if chat_id < 0 else AsyncLimiter(1, 1)
+        _chat_send_limiters[chat_id] = limiter
+        if len(_chat_send_limiters) > CHAT_LIMITERS_SIZE:
+            _chat_send_limiters.popitem(last=False)
+    else:
+        _chat_send_limiters.move_to_end(chat_id)
+    return limiter
+
+# Границы для разбиения длинных сообщений в порядке предпочтения: абзац, строка, предложение, слово
+_SPLIT_SEPARATORS = ('\n\n', '\n', '. ', ' ')
+
+def split_message(content, max_chunk_size=4096):
+    """Разбивает текст на части не длиннее max_chunk_size, по возможности по границам абзацев."""
+    # Telegram не принимает пустые сообщения, поэтому части из одних пробелов не отправляем
+    if len(content) <= max_chunk_size:
+        return [content] if content.strip() else []
+    chunks = []
+    start = 0
+    while len(content) - start > max_chunk_size:
+        end = start + max_chunk_size
+        for separator in _SPLIT_SEPARATORS:
+            cut = content.rfind(separator, start, end)
+            # Точку оставляем в конце части, пробелы и переводы строк отбрасываем
+            chunk = content[start:cut + len(separator.rstrip())]
+            if cut > start and chunk.strip():
+                chunks.append(chunk)
+                start = cut + len(separator)
+                break
+        else:
+            # Подходящей границы нет — режем по максимальному размеру
+            chunk = content[start:end]
+            if chunk.strip():
+                chunks.append(chunk)
+            start = end
+    if content[start:].strip():
+        chunks.append(content[start:])
+    return chunks
+
 async def send_message_in_chunks(update, content, max_chunk_size=4096):
     """Отправка сообщений по частям, если они превышают максимальный размер."""
-    for i in range(0, len(content), max_chunk_size):
-        chunk = content[i:i + max_chunk_size]
-        await update.message.reply_text(chunk)
+    chat_limiter = _chat_send_limiter(update.message.chat_id)
+    for chunk in split_message(content, max_chunk_size):
+        # Ждём свободного места в лимитах, чтобы не получить 429 от Telegram
+        async with chat_limiter, _global_send_limiter:
+            await update.message.reply_text(chunk)
+
+# Блокировки чатов удаляются автоматически, когда их никто не удерживает и не ожидает
+_chat_locks = weakref.WeakValueDictionary()
+
+def _chat_lock(chat_id):
+    """Возвращает блокировку, упорядочивающую обработку сообщений одного чата."""
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+# Сообщения, ожидающие блокировки чата. Пока одно сообщение ждёт, следующие
+# присоединяются к нему, поэтому на чат приходится не больше двух занятых
+# слотов обработчика PTB и один чат не может занять их все
+_queued_messages = {}
+
+# Telegram показывает статус около 5 секунд, поэтому повторяем его чаще
+TYPING_REFRESH_INTERVAL = 4
+
+async def keep_typing(bot, chat_id):
+    """Показывает статус "печатает..." в чате, пока задачу не отменят."""
+    try:
+        while True:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+            await asyncio.sleep(TYPING_REFRESH_INTERVAL)
+    except Exception as e:
+        logger.error("Error sending chat action to chat_id %s: %s", chat_id, e)
 
 async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /clearhistory."""
     chat_id = update.message.chat_id
 
-    # Удаляем запись из базы данных
-    conn = await get_db_connection()
+    # Сообщения, отправленные после /clearhistory, не должны присоединиться
+    # к ходу, который ждёт блокировку и отвечает по старой истории
+    _queued_messages.pop(chat_id, None)
+
+    # Удаляем запись из базы данных сразу, затем историю в памяти
     try:
-        await conn.execute('DELETE FROM user_context WHERE chat_id = $1', chat_id)
-        logger.info(f"Deleted context for chat_id {chat_id}")
+        async with _chat_lock(chat_id):
+            await context.application.persistence.drop_chat_data(chat_id)
+            # Удаляем историю из памяти; PTB также поставит в очередь повторный DELETE
+            context.application.drop_chat_data(chat_id)
         await update.message.reply_text("История успешно удалена.")
-    except Exception as e:
-        logger.error(f"Error deleting context for chat_id {chat_id}: {e}")
+    except Exception:
+        # Ошибка уже записана в лог в PostgresPersistence.drop_chat_data
         await update.message.reply_text("Произошла ошибка при удалении истории.")
-    finally:
-        await conn.close()
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка текстовых сообщений от пользователя."""
-    user_message = update.message.text
+async def answer_message(update, context, user_message):
+    """Отвечает на сообщение пользователя с учётом истории чата."""
     chat_id = update.message.chat_id
-    
-    # Получаем контекст из базы данных
-    context_data = await get_context(chat_id)
-    
+    # Получаем контекст чата; PostgresPersistence загружает его из базы данных
+    # при первом обращении чата после запуска (refresh_chat_data)
+    context_data = context.chat_data.get('ctx')
+
     if not context_data:
         context_data = []
-        logger.debug(f"No previous context found for chat_id {chat_id}. Starting with an empty context.")
-    
+        logger.debug("No previous context found for chat_id %s. Starting with an empty context.", chat_id)
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Context found for chat_id %s: %s", chat_id, context_data)
+    # Ограничиваем историю, чтобы размер запроса к API не рос вместе с диалогом
+    # (срез — копия, сохранённый контекст не меняется до получения ответа)
+    context_data = context_data[-MAX_TURNS * 2:]
+
     # Экранируем сообщение перед обработкой
     user_message_escaped = clean_markdown(user_message)
     # Добавляем сообщение пользователя в контекст
     context_data.append({'role': 'user', 'content': user_message_escaped})
-    
+
     try:
-        # Отправляем сообщение "Печатает...", чтобы уведомить пользователя
-        typing_message = await update.message.reply_text("Печатает...")
-        
-        # Формируем список сообщений для передачи в параметре messages
-        messages = [{'role': msg['role'], 'content': msg['content']} for msg in context_data]
-        
-        # Вызов API Qwen 2.5 Max
-        response = dashscope.Application.call(app_id=QWEN_APP_ID, prompt=user_message_escaped, messages=messages)
-        
-        if response and 'output' in response:
-            output_content = response['output']['text']
-            
-            # Форматируем список, если он есть в ответе
-            formatted_output = format_list_as_markdown(output_content)
-            # Удаляем экранирование
-            clean_output = clean_markdown(formatted_output)
+        # Показываем статус "печатает...", пока ждём ответ от API
+        typing_task = asyncio.create_task(keep_typing(context.bot, chat_id))
+        try:
+            # Вызов API Qwen 2.5 Max; контекст уже имеет формат параметра messages
+            output_content = await call_qwen(
+                context.application.bot_data['http_session'],
+                user_message_escaped,
+                context_data
+            )
+        finally:
+            typing_task.cancel()
+        if output_content is not None:
+            # Форматируем список, если он есть в ответе, и удаляем экранирование
+            clean_output = format_response(output_content)
             # Попробуем отправить текст без MarkdownV2
             try:
                 await send_message_in_chunks(update, clean_output)
             except Exception as e:
                 # В случае ошибки отправляем без форматирования
-                logger.error(f"Ошибка при отправке: {e}")
+                logger.error("Ошибка при отправке: %s", e)
                 await send_message_in_chunks(update, output_content, max_chunk_size=4096)
-            
+        
             # Добавляем ответ бота в контекст
             context_data.append({'role': 'assistant', 'content': clean_output})
-            # Сохраняем обновленный контекст в базе данных
-            await save_context(chat_id, context_data)
+            # Сохраняем обновленный контекст; PTB запишет его в базу данных при следующей синхронизации
+            context.chat_data['ctx'] = context_data[-MAX_TURNS * 2:]
         else:
             await update.message.reply_text("Не удалось получить ответ от API. Попробуйте позже.")
-        
-        # Удаляем сообщение "Печатает..."
-        await typing_message.delete()
     except Exception as e:
-        logger.error(f"Ошибка: {e}")
+        logger.error("Ошибка: %s", e)
         await update.message.reply_text("Произошла ошибка при отправке запроса.")
 
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка текстовых сообщений от пользователя."""
+    chat_id = update.message.chat_id
+    queued = _queued_messages.get(chat_id)
+    if queued is not None:
+        # Это сообщение будет обработано вместе с уже ожидающим
+        queued.append(update.message.text)
+        logger.debug("Message for chat_id %s merged into the queued one", chat_id)
+        return
+    queued = _queued_messages[chat_id] = [update.message.text]
+    # Сообщения одного чата обрабатываются по очереди, разные чаты — параллельно
+    lock = _chat_lock(chat_id)
+    try:
+        await lock.acquire()
+    finally:
+        # Новые сообщения теперь будут ждать уже следующего хода;
+        # /clearhistory мог уже отсоединить этот список
+        if _queued_messages.get(chat_id) is queued:
+            del _queued_messages[chat_id]
+    try:
+        await answer_message(update, context, '\n\n'.join(queued))
+    finally:
+        lock.release()
+
 # Создание и запуск бота
 if __name__ == '__main__':
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    # Загрузка переменных окружения из файла .env
+    load_dotenv()
+    # Настройка логирования: уровень задаётся переменной окружения LOG_LEVEL;
+    # для подробной информации установите DEBUG
+    log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    # getLevelName возвращает число только для известных имён уровней
+    valid_log_level = isinstance(logging.getLevelName(log_level), int)
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=log_level if valid_log_level else logging.INFO
+    )
+    if not valid_log_level:
+        logger.warning("Неизвестный уровень логирования LOG_LEVEL=%s, используется INFO", log_level)
+    # Используем uvloop вместо стандартного цикла событий asyncio, если он установлен
+    # (uvloop недоступен, например, в Windows)
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop не установлен, используется стандартный цикл событий asyncio")
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    application = (
+        ApplicationBuilder()
+        .token(cfg().telegram_bot_token)
+        .concurrent_updates(True)
+        .persistence(PostgresPersistence(update_interval=5))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     # Регистрация обработчиков
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("clearhistory", clear_history))